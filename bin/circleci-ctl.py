@@ -9,11 +9,17 @@
 import os
 import sys
 import csv
+import math
+import array
+import hashlib
 import requests
 import json
 import logging
 import urllib.parse
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from dateutil import parser as dateparser
 
 circle_token_name = os.environ.get("CIRCLECI_TOKEN_VAR_NAME", "CIRCLE_TOKEN")
 
@@ -30,6 +36,190 @@ class Struct:
     def __init__(self, **entries):
         self.__dict__.update(entries)
 
+class StringTable(object):
+    """ Interns strings into small integer ids, so a column can store the id
+        instead of a new copy of the same project/branch/job/status string.
+    """
+    def __init__(self, strings=None):
+        self.strings = list(strings or [])
+        self.ids = { s: i for i, s in enumerate(self.strings) }
+
+    def intern(self, s):
+        i = self.ids.get(s)
+        if i is None:
+            i = self.ids[s] = len(self.strings)
+            self.strings.append(s)
+        return i
+
+class JobColumns(object):
+    """ Compact columnar store of CircleCI v1.1 job records.
+        Each job becomes one row of fixed-width array columns (about 48 bytes),
+        with strings interned into StringTables. Missing times are stored as NaN.
+        Rows repeating a project and build_num (from pages that shifted while
+        paging, or from loading overlapping files) are kept, and stats() counts
+        only the last row of each build_num.
+        Columns can be saved to and loaded from a file with save() / load().
+    """
+    str_columns = ('project', 'branch', 'job', 'status')
+    num_columns = ('build_num', 'start_time', 'run_time', 'queue_time')
+    typecodes = { 'build_num': 'q' }
+    failed_statuses = ('failed', 'infrastructure_fail', 'timedout')
+    file_magic = "circleci-ctl-jobcolumns"
+    file_version = 2
+
+    def __init__(self):
+        self.tables = { c: StringTable() for c in self.str_columns }
+        self.columns = { c: array.array('I') for c in self.str_columns }
+        for c in self.num_columns:
+            self.columns[c] = array.array(self.typecodes.get(c, 'd'))
+
+    def __len__(self):
+        return len(self.columns['start_time'])
+
+    @staticmethod
+    def _timestamp(s):
+        if not s:
+            return math.nan
+        # fromisoformat() is much faster than dateutil, but only takes '+00:00'
+        try:
+            return datetime.fromisoformat(s[:-1] + "+00:00" if s.endswith("Z") else s).timestamp()
+        except ValueError:
+            return dateparser.isoparse(s).timestamp()
+
+    def append(self, project, item):
+        """ Append one job record (a dict from the v1.1 API) as a row """
+        project = self.tables['project'].intern(item.get('reponame') or project)
+        build_num = item.get('build_num')
+        build_num = -1 if build_num is None else int(build_num)
+        workflows = item.get('workflows') or {}
+        build_parameters = item.get('build_parameters') or {}
+        job = workflows.get('job_name') or build_parameters.get('CIRCLE_JOB') or item.get('job_name') or ""
+        status = item.get('status') or item.get('outcome') or ""
+        queued = item.get('usage_queued_at') or item.get('queued_at')
+        start = self._timestamp(item.get('start_time'))
+        queue_time = start - self._timestamp(queued) if queued else math.nan
+        run_time = item.get('build_time_millis')
+        run_time = run_time / 1000.0 if run_time is not None else math.nan
+        if math.isnan(start):
+            start = self._timestamp(queued)
+
+        self.columns['project'].append(project)
+        for c, v in (('branch', item.get('branch') or ""), ('job', job), ('status', status)):
+            self.columns[c].append( self.tables[c].intern(v) )
+        self.columns['build_num'].append(build_num)
+        self.columns['start_time'].append(start)
+        self.columns['run_time'].append(run_time)
+        self.columns['queue_time'].append(queue_time)
+
+    def save(self, path):
+        """ Write the columns to 'path': one JSON header line followed by
+            the raw bytes of each column, in header order.
+        """
+        header = {
+            "magic": self.file_magic, "version": self.file_version, "rows": len(self),
+            "byteorder": sys.byteorder,
+            "tables": { c: self.tables[c].strings for c in self.str_columns },
+            "columns": [ [c, self.columns[c].typecode] for c in self.str_columns + self.num_columns ]
+        }
+        with open(path, 'wb') as f:
+            f.write( (json.dumps(header) + "\n").encode() )
+            for c in self.str_columns + self.num_columns:
+                self.columns[c].tofile(f)
+
+    @classmethod
+    def load(cls, path):
+        """ Read columns previously written by save() """
+        self = cls()
+        with open(path, 'rb') as f:
+            header = json.loads(f.readline())
+            if header.get('magic') != cls.file_magic or header.get('version') != cls.file_version:
+                raise Exception("'%s' is not a job_stats column file" % path)
+            for c in cls.str_columns:
+                self.tables[c] = StringTable(header['tables'][c])
+            for c, typecode in header['columns']:
+                col = array.array(typecode)
+                col.fromfile(f, header['rows'])
+                if header['byteorder'] != sys.byteorder:
+                    col.byteswap()
+                self.columns[c] = col
+        return self
+
+    def extend(self, other):
+        """ Append the rows of another JobColumns, re-interning its strings """
+        for c in self.str_columns:
+            remap = [ self.tables[c].intern(s) for s in other.tables[c].strings ]
+            self.columns[c].extend( remap[i] for i in other.columns[c] )
+        for c in self.num_columns:
+            self.columns[c].extend(other.columns[c])
+
+    @staticmethod
+    def unique_rows(idx, build_num):
+        """ Drop all but the last of the rows in 'idx' that share a build_num.
+            Rows without a build_num (-1) are all kept.
+            All rows of a build_num share a (project, branch, job) group, so
+            this only needs a temporary dict the size of one group.
+        """
+        last = {}
+        numbered = 0
+        for i in idx:
+            if build_num[i] >= 0:
+                last[build_num[i]] = i
+                numbered += 1
+        if len(last) == numbered:
+            return idx
+        return array.array('I', ( i for i in idx if build_num[i] < 0 or last[build_num[i]] == i ))
+
+    @staticmethod
+    def percentiles(values, pcts):
+        """ Nearest-rank percentiles of 'values', ignoring NaN """
+        values = sorted( v for v in values if not math.isnan(v) )
+        if len(values) < 1:
+            return { "p%g" % p: None for p in pcts }
+        return { "p%g" % p: values[ max(0, math.ceil(len(values) * p / 100.0) - 1) ] for p in pcts }
+
+    def stats(self, pcts=(50, 90, 99), window=86400):
+        """ Aggregate rows per (project, branch, job).
+            Returns an array of dicts with run time and queue time percentiles
+            (in seconds), the failure rate, and job/failure counts per time
+            window of 'window' seconds.
+        """
+        project, branch, job = self.columns['project'], self.columns['branch'], self.columns['job']
+        status, start = self.columns['status'], self.columns['start_time']
+        run_time, queue_time = self.columns['run_time'], self.columns['queue_time']
+        failed_ids = set( self.tables['status'].ids[s] for s in self.failed_statuses if s in self.tables['status'].ids )
+
+        groups = defaultdict(lambda: array.array('I'))
+        for i in range(len(self)):
+            groups[ (project[i], branch[i], job[i]) ].append(i)
+
+        rows = []
+        for (p, b, j), idx in sorted(groups.items()):
+            idx = self.unique_rows(idx, self.columns['build_num'])
+            failed = 0
+            windows = defaultdict(lambda: [0, 0])
+            for i in idx:
+                is_failed = status[i] in failed_ids
+                failed += is_failed
+                if not math.isnan(start[i]):
+                    w = windows[ int(start[i] // window) * window ]
+                    w[0] += 1
+                    w[1] += is_failed
+            rows.append({
+                "project": self.tables['project'].strings[p],
+                "branch": self.tables['branch'].strings[b],
+                "job": self.tables['job'].strings[j],
+                "jobs": len(idx),
+                "failed": failed,
+                "failure_rate": failed / len(idx),
+                "run_time": self.percentiles( (run_time[i] for i in idx), pcts ),
+                "queue_time": self.percentiles( (queue_time[i] for i in idx), pcts ),
+                "windows": [
+                    { "start": datetime.fromtimestamp(w, timezone.utc).isoformat(), "jobs": n, "failed": f }
+                    for w, (n, f) in sorted(windows.items())
+                ]
+            })
+        return rows
+
 class ManageCircle(object):
     """ Class for managing CircleCI functionality """
     csvw = None
@@ -94,7 +284,7 @@ class ManageCircle(object):
             page again but adding the token with '&page-token=%s' to
             the request.
             Pass --maxpages=N and --limit=N to override the defaults
-            for pagination.
+            for pagination; --maxpages=0 fetches every page.
         """
         maxpages = 10
         if hasattr(self.opts, 'maxpages'):
@@ -102,6 +292,11 @@ class ManageCircle(object):
         url = circle_api_base_url + "/v" + apiver + "/" + urlstr[:]
         next_page_token = None
         next_page_url = url[:]
+        limit = 20
+        if hasattr(self.opts, 'limit'):
+            limit = int(self.opts.limit)
+        if apiver != "2":
+            next_page_url = url[:] + ("&limit=%i&offset=0" % limit)
         counter=1
         while next_page_url is not None:
             try:
@@ -121,10 +316,10 @@ class ManageCircle(object):
                     if next_page_token != None:
                         next_page_url = url[:] + "&page-token=%s" % next_page_token
             else:
-                limit = 20
-                if hasattr(self.opts, 'limit'):
-                    limit = self.opts.limit
-                next_page_url = url[:] + ("&limit=%s&offset=%i" % (limit, counter))
+                # v1.1 pages by offset; a short page is the last one
+                next_page_url = None
+                if isinstance(page_json, list) and len(page_json) >= limit:
+                    next_page_url = url[:] + ("&limit=%i&offset=%i" % (limit, counter * limit))
 
             if counter == maxpages:
                 break
@@ -179,6 +374,15 @@ class ManageCircle(object):
             Returns an array of dicts.
         """
         rows = []
+        for project, branchpostfix, key in self._iter_project_jobs(args):
+            rows.append({ "vcs":args.vcs, "org":args.org, "project":project, "branch":branchpostfix, "item":key })
+        return rows
+
+    def _iter_project_jobs(self, args):
+        """ Generator behind _get_project_jobs.
+            Yields (project, branchpostfix, item) for each job as each page
+            arrives, so callers don't have to hold the whole history in memory.
+        """
         apivcs = self.vcs(args.vcs, "1")
         for project in self.load_list(args.projects):
             branchpostfix, filterpostfix = "", ""
@@ -192,15 +396,56 @@ class ManageCircle(object):
             )
             for j in self.get_api_json(urlfmt, "1.1"):
                 if j is None: continue
+                # errors like a missing project come back as an object, not a list
+                if not isinstance(j, list):
+                    logging.error( ("Error getting jobs for project '%s': '%s'" % (project, j)) )
+                    break
                 for key in j:
-                    rows.append({ "vcs":args.vcs, "org":args.org, "project":project, "branch":branchpostfix, "item":key })
-        return rows
+                    if isinstance(key, dict):
+                        yield project, branchpostfix, key
 
     def get_project_jobs(self, args):
         """ Runs _get_project_jobs and dumps the result as JSON """
         rows = self._get_project_jobs(args)
         print(json.dumps(rows))
 
+    def _job_stats(self, args):
+        """ Stream jobs for the projects into a JobColumns store.
+            Can pass 'load' to start from previously saved columns (the API is
+            not queried unless 'projects' is also passed), and 'save' to write
+            the columns out for reuse.
+            Unlike the other commands, all pages are fetched by default, 100
+            jobs at a time; pass 'maxpages' / 'limit' to change that.
+            Returns a JobColumns.
+        """
+        if self.opts is not None:
+            if not hasattr(self.opts, 'maxpages'):
+                self.opts.maxpages = 0
+            if not hasattr(self.opts, 'limit'):
+                self.opts.limit = 100
+        cols = JobColumns()
+        if hasattr(args, 'load'):
+            for path in self.load_list(args.load):
+                cols.extend( JobColumns.load(path) )
+        if hasattr(args, 'projects'):
+            for project, branchpostfix, key in self._iter_project_jobs(args):
+                cols.append(project, key)
+        if hasattr(args, 'save'):
+            cols.save(args.save)
+        return cols
+
+    def job_stats(self, args):
+        """ Runs _job_stats and dumps the aggregated statistics as JSON.
+            Can pass 'percentiles' (comma-separated) and 'window' (seconds).
+        """
+        pcts, window = (50, 90, 99), 86400
+        if hasattr(args, 'percentiles'):
+            pcts = [ float(p) for p in self.load_list(args.percentiles) ]
+        if hasattr(args, 'window'):
+            window = int(args.window)
+        cols = self._job_stats(args)
+        print(json.dumps(cols.stats(pcts=pcts, window=window)))
+
     def _get_workflow(self, args):
         """ Get the data for a particular workflow.
             Returns an array of dicts.
@@ -257,6 +502,100 @@ class ManageCircle(object):
                 for key in j['items']:
                     self.csvw.writerow( [ vcs, org, proj, key['type'], key['preferred'], key['created_at'], key['public_key'].rstrip(), key['fingerprint'] ] )
 
+    def _get_project_items(self, vcs, org, proj, path):
+        """ Get all 'items' from a v2 project endpoint like 'envvar' or 'checkout-key'.
+            Returns an array of dicts, or None if a page came back without 'items'.
+        """
+        items = []
+        url = "project/%s/%s/%s/%s" % (vcs, org, proj, path)
+        for j in self.get_api_json(url, "2"):
+            if j is None or not 'items' in j:
+                logging.error( ("Error getting '%s': '%s'" % (url, j)) )
+                return None
+            items.extend(j['items'])
+        return items
+
+    @staticmethod
+    def _digest(*values):
+        return hashlib.sha1( json.dumps(values, sort_keys=True).encode() ).hexdigest()
+
+    def _audit_project(self, vcs, org, proj):
+        """ Fetch env vars and checkout keys of a project and reduce them to digests.
+            The API only returns env var values masked ('xxxx' plus the last 4
+            characters), so an env var counts as changed only if those differ.
+            Returns a snapshot entry dict, or None if either fetch failed.
+        """
+        try:
+            envvars = self._get_project_items(vcs, org, proj, "envvar")
+            keys = self._get_project_items(vcs, org, proj, "checkout-key")
+        except Exception as e:
+            logging.error( ("Error auditing project '%s/%s/%s': %s" % (vcs, org, proj, e)) )
+            return None
+        if envvars is None or keys is None:
+            return None
+        entry = {
+            "envvar": { k['name']: self._digest(k['value']) for k in envvars },
+            "checkout-key": {
+                k['fingerprint']: self._digest(k['type'], k['preferred'], k['created_at'], k['public_key'].rstrip())
+                for k in keys
+            }
+        }
+        entry['digest'] = self._digest(entry['envvar'], entry['checkout-key'])
+        return entry
+
+    def _audit(self, args):
+        """ Fetch env vars and checkout keys for all projects concurrently and
+            compare them against the previous snapshot in 'snapshot' (if it exists).
+            Only value digests are kept in the snapshot. Can pass 'workers' to
+            change the number of concurrent fetches (default 16).
+            Returns (new snapshot dict, array of changed rows).
+        """
+        vcs = self.vcs(args.vcs, "2")
+        workers = 16
+        if hasattr(args, 'workers'):
+            workers = int(args.workers)
+        previous = {}
+        if os.path.exists(args.snapshot):
+            with open(args.snapshot) as f:
+                previous = json.load(f)
+
+        projects = self.load_list(args.projects)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            entries = pool.map(lambda proj: self._audit_project(vcs, args.org, proj), projects)
+            results = list(zip(projects, entries))
+
+        snapshot, rows = dict(previous), []
+        for proj, entry in results:
+            slug = "%s/%s/%s" % (vcs, args.org, proj)
+            if entry is None:
+                continue
+            snapshot[slug] = entry
+            old = previous.get(slug, {})
+            if old.get('digest') == entry['digest']:
+                continue
+            for kind in ("envvar", "checkout-key"):
+                was, now = old.get(kind, {}), entry[kind]
+                for name in sorted(set(was) | set(now)):
+                    if name not in was:
+                        change = "added"
+                    elif name not in now:
+                        change = "removed"
+                    elif was[name] != now[name]:
+                        change = "changed"
+                    else:
+                        continue
+                    rows.append( [ args.vcs, args.org, proj, kind, name, change ] )
+        return snapshot, rows
+
+    def audit(self, args):
+        """ Runs _audit, prints the changes as a CSV file and writes the new snapshot """
+        snapshot, rows = self._audit(args)
+        self.csvw = csv.writer(sys.stdout, quoting=csv.QUOTE_NONNUMERIC)
+        self.csvw.writerow( [ "vcs", "org", "project", "kind", "name", "change" ] )
+        self.csvw.writerows(rows)
+        with open(args.snapshot, "w") as f:
+            json.dump(snapshot, f, sort_keys=True)
+
     def create_checkout_key(self, args):
         """ create_checkout_key(vcs, org, project)
             Creates a checkout key in a project.
@@ -311,11 +650,31 @@ get_project_vars VCS ORG PROJECT
                     -   List all the project-specific environment variables.
                         Prints out a CSV file.
 
+audit --vcs=bitbucket --org=ORG --projects=REPO --snapshot=FILE [--workers=16]
+                    -   Fetch the environment variables and checkout keys of all projects
+                        concurrently and compare them with the snapshot in FILE. Prints a
+                        CSV file of the env vars and keys that were added, removed or
+                        changed, then updates FILE. Only digests of values are stored.
+                        CircleCI only returns env var values masked to their last 4
+                        characters, so a changed value is only reported if those change.
+
 get_project_jobs --vcs=bitbucket --org=ORG --projects=REPO [--branch=master]
                  [--filter=completed]
                     -   List all jobs under a project (repo). Filter values:
                             "completed", "successful", "failed", "running"
 
+job_stats --vcs=bitbucket --org=ORG --projects=REPO [--branch=master]
+          [--filter=completed] [--percentiles=50,90,99] [--window=86400]
+          [--save=FILE] [--load=FILE] [--maxpages=0] [--limit=100]
+                    -   Stream all jobs under a project (repo) into compact columns and
+                        print per project/branch/job run time and queue time percentiles
+                        (seconds), failure rate, and job counts per --window seconds.
+                        --save writes the columns to FILE; --load reads them back (the
+                        API, and CIRCLE_TOKEN, are only needed if --projects is also
+                        passed). Jobs are de-duplicated by project and build number.
+                        Every page of jobs is fetched unless --maxpages=N is passed, in
+                        which case only the newest N*limit jobs per project are counted.
+
 get_pipelines --vcs=bitbucket --org=ORG --projects=REPO [--branch=master]
                     -   List all pipelines under a project (repo)
 
@@ -337,11 +696,6 @@ def main():
     if len(sys.argv) < 2:
         usage()
 
-    if not os.environ.get(circle_token_name):
-        logging.error( ("You must pass environment variable %s" % circle_token_name) )
-        exit(1)
-    headers['Circle-Token'] = os.environ[circle_token_name]
-
     # turn sys.argv's '--foo=bar' into object 'opts' with attribute 'foo' returning ["bar"].
     # supports multiple uses of '--foo'
     d=defaultdict(list)
@@ -351,6 +705,13 @@ def main():
         d[k] = d[k][0]
     opts = Struct(**d)
 
+    # job_stats with only --load never calls the API
+    if not (sys.argv[1] == "job_stats" and not hasattr(opts, 'projects')):
+        if not os.environ.get(circle_token_name):
+            logging.error( ("You must pass environment variable %s" % circle_token_name) )
+            exit(1)
+        headers['Circle-Token'] = os.environ[circle_token_name]
+
     o = ManageCircle(opts=opts)
     if sys.argv[1] == "get_checkout_keys":
         o.get_checkout_keys(sys.argv[2:])
@@ -364,6 +725,10 @@ def main():
         o.get_project_vars(sys.argv[2:])
     elif sys.argv[1] == "get_project_jobs":
         o.get_project_jobs(opts)
+    elif sys.argv[1] == "audit":
+        o.audit(opts)
+    elif sys.argv[1] == "job_stats":
+        o.job_stats(opts)
     elif sys.argv[1] == "get_pipelines":
         o.get_pipelines(opts)
     elif sys.argv[1] == "get_workflow":
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# bench-extract-k8s-data.py - generate synthetic k8s manifests and time extract-k8s-data.py
+
+import os
+import sys
+import json
+import time
+import getopt
+import random
+import tempfile
+import contextlib
+import tracemalloc
+import importlib.util
+from pathlib import Path
+
+EXTRACTOR = Path(__file__).resolve().parent / "extract-k8s-data.py"
+
+class ManifestCorpus(object):
+    """ Generates a synthetic multi-document Kubernetes manifest as YAML text """
+    deployments = 10
+    containers = 2
+    ports = 2
+    probes = 2
+    env = 10
+    secrets = 5
+    secret_keys = 5
+    seed = 0
+
+    def __init__(self, **opts):
+        self.__dict__.update(opts)
+        self.random = random.Random(self.seed)
+
+    def _word(self, n=8):
+        return "".join(self.random.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(n))
+
+    def _probe(self, kind, c):
+        lines = ["          %s:" % kind]
+        probe_type = c % 3
+        if probe_type == 0:
+            lines += ["            httpGet:", "              path: /healthz", "              port: 8080"]
+        elif probe_type == 1:
+            lines += ["            tcpSocket:", "              port: 8080"]
+        else:
+            lines += ["            exec:", "              command:", "              - cat", "              - /tmp/healthy"]
+        lines += ["            initialDelaySeconds: 5", "            periodSeconds: 10",
+                  "            timeoutSeconds: 1", "            failureThreshold: 3"]
+        return lines
+
+    def deployment(self, d):
+        name = "app-%i-%s" % (d, self._word(4))
+        lines = ["apiVersion: apps/v1", "kind: Deployment", "metadata:", "  name: %s" % name,
+                 "spec:", "  replicas: 1", "  template:", "    metadata:", "      labels:",
+                 "        app: %s" % name, "    spec:", "      volumes:",
+                 "      - name: config", "        configMap:", "          name: %s-config" % name,
+                 "      containers:"]
+        for c in range(self.containers):
+            cname = "%s-c%i" % (name, c)
+            lines += ["      - name: %s" % cname, "        image: gcr.io/example/%s:1.%i.0" % (cname, c)]
+            if self.ports > 0:
+                lines += ["        ports:"]
+                for p in range(self.ports):
+                    lines += ["        - containerPort: %i" % (8080 + p)]
+            if self.env > 0:
+                lines += ["        env:"]
+                for e in range(self.env):
+                    lines += ["        - name: ENV_%i_%s" % (e, self._word().upper()),
+                              "          value: \"%s\"" % self._word(24)]
+            lines += ["        volumeMounts:", "        - name: config", "          mountPath: /etc/config",
+                      "        resources:", "          limits:", "            cpu: 500m",
+                      "            memory: 512Mi", "          requests:", "            cpu: 100m",
+                      "            memory: 128Mi"]
+            for probe in ("readinessProbe", "livenessProbe")[:self.probes]:
+                lines += self._probe(probe, c)
+        return "\n".join(lines) + "\n"
+
+    def secret(self, s):
+        lines = ["apiVersion: v1", "kind: Secret", "metadata:", "  name: secret-%i-%s" % (s, self._word(4)),
+                 "type: Opaque", "data:"]
+        for k in range(self.secret_keys):
+            lines += ["  key-%i: %s" % (k, self._word(32))]
+        return "\n".join(lines) + "\n"
+
+    def documents(self):
+        for d in range(self.deployments):
+            yield self.deployment(d)
+        for s in range(self.secrets):
+            yield self.secret(s)
+
+    def write(self, path):
+        """ Write the corpus to 'path'. Returns the number of documents written. """
+        n = 0
+        with open(path, "w") as f:
+            for doc in self.documents():
+                f.write("---\n")
+                f.write(doc)
+                n += 1
+        return n
+
+class BenchExtractor(object):
+    """ Times each phase of MakeHelmChartTemplate separately.
+        Each phase is timed 'repeat' times without tracing (reporting the best
+        run), then once more under tracemalloc to get its peak memory.
+    """
+    repeat = 3
+    formats = ("json", "yaml")
+
+    def __init__(self, manifests, **opts):
+        self.manifests = manifests
+        self.__dict__.update(opts)
+        spec = importlib.util.spec_from_file_location("extract_k8s_data", EXTRACTOR)
+        self.module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(self.module)
+        self.input_bytes = sum(os.path.getsize(f) for f in manifests)
+
+    def new_extractor(self, fmt):
+        o = self.module.MakeHelmChartTemplate()
+        # the class keeps its lists as class attributes; give each run its own
+        o.docs, o.extracted = [], []
+        o.k8s_manifest = list(self.manifests)
+        o.dump_json, o.dump_yaml = fmt == "json", fmt == "yaml"
+        return o
+
+    def phases(self, fmt):
+        """ Run all phases once on a fresh extractor, yielding (phase, seconds, extractor) """
+        o = self.new_extractor(fmt)
+        for phase, func in (("load_k8s_manifests", o.load_k8s_manifests),
+                            ("process_manifests", o.process_manifests),
+                            ("cmd_dump_all", o.cmd_dump_all)):
+            start = time.perf_counter()
+            func()
+            yield phase, time.perf_counter() - start, o
+
+    def run_format(self, fmt, outdir):
+        best, peak = {}, {}
+        cwd = os.getcwd()
+        os.chdir(outdir)
+        try:
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                for _ in range(self.repeat):
+                    for phase, secs, o in self.phases(fmt):
+                        best[phase] = min(secs, best.get(phase, secs))
+                tracemalloc.start()
+                for phase, secs, o in self.phases(fmt):
+                    peak[phase] = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.reset_peak()
+                tracemalloc.stop()
+            docs = len(o.docs)
+            output_bytes = sum(f.stat().st_size for f in Path(outdir).iterdir())
+        finally:
+            os.chdir(cwd)
+
+        report = {}
+        for phase, secs in best.items():
+            nbytes = output_bytes if phase == "cmd_dump_all" else self.input_bytes
+            report[phase] = {
+                "seconds": secs,
+                "docs_per_sec": docs / secs if secs > 0 else None,
+                "bytes_per_sec": nbytes / secs if secs > 0 else None,
+                "peak_memory_bytes": peak[phase],
+            }
+        return { "docs": docs, "input_bytes": self.input_bytes, "output_bytes": output_bytes,
+                 "output_files": len(os.listdir(outdir)), "phases": report }
+
+    def run(self):
+        results = {}
+        for fmt in self.formats:
+            with tempfile.TemporaryDirectory() as outdir:
+                results[fmt] = self.run_format(fmt, outdir)
+        return results
+
+def usage():
+    usage = """Usage: %s [OPTIONS] COMMAND [ARGS ..]
+
+Commands:
+    generate FILE                       Writes a synthetic multi-document manifest
+                                        corpus to FILE
+    run [MANIFEST ..]                   Times load_k8s_manifests, process_manifests and
+                                        cmd_dump_all of extract-k8s-data.py for JSON and
+                                        YAML output and prints a JSON report. Without
+                                        MANIFEST, a corpus is generated in a temp dir
+
+Generator options:
+    --deployments=N             Number of Deployment documents (default 10)
+    --containers=N              Containers per pod (default 2)
+    --ports=N                   Ports per container (default 2)
+    --probes=N                  Probes per container, 0-2 (default 2)
+    --env=N                     Env vars per container (default 10)
+    --secrets=N                 Number of Secret documents (default 5)
+    --secret-keys=N             Data keys per Secret (default 5)
+    --seed=N                    Random seed (default 0)
+
+Run options:
+    -r,--repeat=N               Timed runs per phase, best is reported (default 3)
+    -j,--json                   Only benchmark JSON output
+    -y,--yaml                   Only benchmark YAML output
+""" % sys.argv[0]
+    print(usage)
+    exit(1)
+
+def main(argv):
+    corpus_opts, bench_opts = {}, {}
+    opts, args = getopt.getopt(argv, "r:jy", ["deployments=", "containers=", "ports=", "probes=",
+                                              "env=", "secrets=", "secret-keys=", "seed=",
+                                              "repeat=", "json", "yaml"])
+    for opt, arg in opts:
+        if opt in ("-r", "--repeat"):
+            bench_opts['repeat'] = int(arg)
+        elif opt in ("-j", "--json"):
+            bench_opts['formats'] = ("json",)
+        elif opt in ("-y", "--yaml"):
+            bench_opts['formats'] = ("yaml",)
+        else:
+            corpus_opts[opt.lstrip('-').replace('-', '_')] = int(arg)
+    if len(args) < 1:
+        usage()
+    if args[0] == "generate":
+        if len(args) != 2:
+            raise Exception("please pass one FILE to write the corpus to")
+        n = ManifestCorpus(**corpus_opts).write(args[1])
+        print("wrote %i documents to '%s'" % (n, args[1]))
+    elif args[0] == "run":
+        with tempfile.TemporaryDirectory() as tmpdir:
+            manifests = args[1:]
+            if len(manifests) < 1:
+                manifests = [os.path.join(tmpdir, "corpus.yaml")]
+                ManifestCorpus(**corpus_opts).write(manifests[0])
+            report = BenchExtractor(manifests, **bench_opts).run()
+        print(json.dumps(report, sort_keys=True, indent=4))
+    else:
+        usage()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
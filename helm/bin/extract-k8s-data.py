@@ -2,8 +2,13 @@
 # extract-k8s-data.py - extract data from k8s manifests into a simpler structure
 
 import os
+import re
 import sys
 import json
+import time
+import cProfile
+import contextlib
+import tracemalloc
 import shutil
 import getopt
 import hashlib
@@ -23,114 +28,300 @@ class MyYAML(YAML):
         if inefficient:
             return stream.getvalue()
 
+# Workload kinds to extract containers from: kind -> (path to the pod spec, output file prefix)
+WORKLOAD_KINDS = {
+    "Deployment":   (("spec", "template", "spec"), "deployment-"),
+    "StatefulSet":  (("spec", "template", "spec"), "statefulset-"),
+    "DaemonSet":    (("spec", "template", "spec"), "daemonset-"),
+    "ReplicaSet":   (("spec", "template", "spec"), "replicaset-"),
+    "Job":          (("spec", "template", "spec"), "job-"),
+    "CronJob":      (("spec", "jobTemplate", "spec", "template", "spec"), "cronjob-"),
+    "Pod":          (("spec",), "pod-"),
+}
+# Pod spec container lists: (key, output file prefix infix)
+CONTAINER_LISTS = (("containers", "container-"), ("initContainers", "initcontainer-"))
+# Container fields to extract: key -> (output key, how to extract it)
+#   value: copy as-is; dump: dump as YAML; wrap: dump as YAML under its own key;
+#   ports: 'port' and 'additionalPorts'; probe: simplified probe dumped as YAML
+CONTAINER_FIELDS = {
+    "name":             ("name", "value"),
+    "image":            ("image", "value"),
+    "ports":            (None, "ports"),
+    "volumeMounts":     ("volume-mounts", "wrap"),
+    "env":              ("env", "dump"),
+    "resources":        ("resources", "wrap"),
+    "readinessProbe":   ("readinessProbe", "probe"),
+    "livenessProbe":    ("livenessProbe", "probe"),
+    "startupProbe":     ("startupProbe", "probe"),
+}
+PROBE_ARGS = ('initialDelaySeconds', 'periodSeconds', 'timeoutSeconds', 'successThreshold', 'failureThreshold')
+
+class Profiler(object):
+    """ Records wall time per phase, in total and per input file, and with
+        'memory' also traced memory. Phases can nest; 'self_seconds' excludes
+        the time spent in nested phases. 'alloc_bytes' is the net change in
+        traced memory and 'peak_bytes' the highest traced memory above what was
+        in use when the phase started. Tracing memory slows everything down, so
+        times recorded with 'memory' are not comparable to untraced runs.
+    """
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.file = None
+        self.doc_files = {}
+        self.phases = {}
+        self.files = {}
+        self.stack = []
+        self.start = time.perf_counter()
+        if memory:
+            tracemalloc.start()
+
+    def _add(self, stats, name, seconds, self_seconds, alloc, peak):
+        st = stats.get(name)
+        if st is None:
+            st = stats[name] = { "calls": 0, "seconds": 0.0, "self_seconds": 0.0 }
+            if self.memory:
+                st.update({ "alloc_bytes": 0, "peak_bytes": 0 })
+        st['calls'] += 1
+        st['seconds'] += seconds
+        st['self_seconds'] += self_seconds
+        if self.memory:
+            st['alloc_bytes'] += alloc
+            st['peak_bytes'] = max(st['peak_bytes'], peak)
+
+    @contextlib.contextmanager
+    def phase(self, name, file=None):
+        if file is None:
+            file = self.file
+        mem, peak = tracemalloc.get_traced_memory() if self.memory else (0, 0)
+        if self.stack:
+            # the peak is reset below, so hand the enclosing phase its peak so far
+            self.stack[-1][1] = max(self.stack[-1][1], peak)
+        # [start memory, highest peak seen in nested phases, seconds in nested phases]
+        frame = [mem, mem, 0.0]
+        self.stack.append(frame)
+        if self.memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            mem, peak = tracemalloc.get_traced_memory() if self.memory else (0, 0)
+            self.stack.pop()
+            peak = max(peak, frame[1])
+            args = (name, seconds, seconds - frame[2], mem - frame[0], peak - frame[0])
+            self._add(self.phases, *args)
+            if file is not None:
+                self._add(self.files.setdefault(file, {}), *args)
+            if self.stack:
+                self.stack[-1][1] = max(self.stack[-1][1], peak)
+                self.stack[-1][2] += seconds
+
+    def wrap(self, name, func):
+        def wrapped(*args, **kw):
+            with self.phase(name):
+                return func(*args, **kw)
+        return wrapped
+
+    def report(self):
+        report = { "seconds": time.perf_counter() - self.start, "memory_traced": self.memory,
+                   "phases": self.phases, "files": self.files }
+        if self.memory:
+            report['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        return report
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, sort_keys=True, indent=4)
+
 class MakeHelmChartTemplate(object):
     yaml = None
     docs = []
-    deployments = []
-    secrets = []
+    extracted = []
     k8s_manifest = []
     dump_json = False
     dump_yaml = True
+    quiet = False
+    profiler = None
+    # split a multi-document stream before each '---' marker, keeping the marker
+    doc_start = re.compile(r'^(?=---(?:\s|$))', re.M)
+
+    def enable_profiling(self, memory=False):
+        """ Record phases with a Profiler: read, parse, extract:KIND, dump (YAML
+            fragments dumped while extracting) and write.
+        """
+        self.profiler = Profiler(memory=memory)
+        self.dump_fragment = self.profiler.wrap("dump", self.dump_fragment)
+
+    def phase(self, name, file=None):
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.phase(name, file)
 
     def load_yaml(self, file):
-        print("load_yaml('%s')" % file)
-        with open(file, 'r') as f:
-            self.filedata = f.read()
+        if not self.quiet: print("load_yaml('%s')" % file)
+        with self.phase("read", file):
+            with open(file, 'r') as f:
+                self.filedata = f.read()
         self.yaml = MyYAML(typ='safe')
-        for doc in self.yaml.load_all(self.filedata):
-            self.docs.append(doc)
+        with self.phase("parse", file):
+            for doc in self.yaml.load_all(self.filedata):
+                self.docs.append(doc)
+                if self.profiler is not None:
+                    self.profiler.doc_files[id(doc)] = file
 
     def load_k8s_manifests(self):
-        print("load_k8s_manifests()")
+        if not self.quiet: print("load_k8s_manifests()")
         for f in self.k8s_manifest:
             self.load_yaml(f)
 
     def process_manifests(self):
-        print("process_manifests()")
+        if not self.quiet: print("process_manifests()")
         if len(self.k8s_manifest) > 0 and len(self.docs) < 1:
             self.load_k8s_manifests()
         for doc in self.docs:
-            if not 'apiVersion' in doc:
-                raise Exception("no 'apiVersion' found in manifest (%s)" % doc)
-            if not 'kind' in doc:
-                raise Exception("no 'kind' found in manifest (%s)" % doc)
-            if doc['kind'].lower() == "deployment":
-                self.load_deployments(doc)
-            elif doc['kind'].lower() == "secret":
-                self.load_secrets(doc)
-            else:
-                print("Warning: Skipping unknown manifest kind '%s'" % doc['kind'])
-
-    def load_deployments(self, doc):
-        print("load_deployments()" % doc)
-        if not 'spec' in doc:
-            raise Exception("'spec' missing from deployment")
-        spec = doc['spec']
-        if not 'template' in spec:
-            raise Exception("'template' missing from spec")
+            if self.profiler is not None:
+                self.profiler.file = self.profiler.doc_files.get(id(doc))
+            self.process_doc(doc)
+        if self.profiler is not None:
+            self.profiler.file = None
+
+    def process_doc(self, doc):
+        """ Extract one manifest document into self.extracted """
+        if not 'apiVersion' in doc:
+            raise Exception("no 'apiVersion' found in manifest (%s)" % doc)
+        if not 'kind' in doc:
+            raise Exception("no 'kind' found in manifest (%s)" % doc)
+        handler = self.kind_index.get(doc['kind'].lower())
+        if handler is None:
+            print("Warning: Skipping unknown manifest kind '%s'" % doc['kind'])
+        elif self.profiler is None:
+            handler(self, doc)
         else:
-            template = spec['template']
-        if not 'spec' in template:
-            exception("'spec' missing from template")
-        templatespec = template['spec']
-        if not 'containers' in templatespec:
+            with self.profiler.phase("extract:%s" % doc['kind']):
+                handler(self, doc)
+
+    @classmethod
+    def compile_spec(cls):
+        """ Compile WORKLOAD_KINDS and CONTAINER_FIELDS into cls.kind_index, a map
+            of lowercased kind to a function(self, doc) that extracts the document.
+            Called once at import time, so the per-document work is a dict lookup
+            plus one pass over each container's keys.
+        """
+        fields = {}
+        for key, (out, mode) in CONTAINER_FIELDS.items():
+            fields[key] = getattr(cls, "_field_" + mode)(key, out)
+        cls.container_fields = fields
+
+        cls.kind_index = { "secret": cls.load_secrets }
+        for kind, (path, fileprefix) in WORKLOAD_KINDS.items():
+            cls.kind_index[kind.lower()] = cls._workload_handler(kind, path, fileprefix)
+
+    @staticmethod
+    def _workload_handler(kind, path, fileprefix):
+        def handler(self, doc):
+            if not self.quiet: print("load_workload('%s')" % kind)
+            node, parent = doc, kind
+            for key in path:
+                try:
+                    node = node[key]
+                except (KeyError, TypeError):
+                    raise Exception("'%s' missing from %s" % (key, parent))
+                parent = key
+            self.load_pod_spec(node, fileprefix)
+        return handler
+
+    @staticmethod
+    def _field_value(key, out):
+        def extract(self, value, collect):
+            collect[out] = value
+        return extract
+
+    @staticmethod
+    def _field_dump(key, out):
+        def extract(self, value, collect):
+            collect[out] = self.dump_fragment(value)
+        return extract
+
+    @staticmethod
+    def _field_wrap(key, out):
+        def extract(self, value, collect):
+            collect[out] = self.dump_fragment({ key: value })
+        return extract
+
+    @staticmethod
+    def _field_ports(key, out):
+        def extract(self, value, collect):
+            self.load_ports(value, collect)
+        return extract
+
+    @staticmethod
+    def _field_probe(key, out):
+        def extract(self, value, collect):
+            collect[out] = self.dump_fragment({ key: self.load_probe(value) })
+        return extract
+
+    def dump_fragment(self, data):
+        """ Dump a piece of extracted data to a YAML string """
+        return self.yaml.dump(data)
+
+    def load_pod_spec(self, podspec, fileprefix):
+        if not 'containers' in podspec:
             raise Exception("'containers' missing from templatespec")
-        for container in templatespec['containers']:
-            collect = {}
-            if 'volumes' in templatespec:
-                collect['volumes'] = self.yaml.dump({ "volumes": templatespec['volumes'] })
-            collect['name'] = container['name']
-            collect['image'] = container['image']
-            if 'ports' in container and len(container['ports']) > 0:
-                ports = container['ports'].copy()
-                port = ports.pop(0)
-                collect['port'] = port['containerPort']
-                if len(ports) > 0:
-                    c, newports = 0, []
-                    for addlport in ports:
-                        c+=1
-                        newport = {}
-                        if 'name' in addlport:
-                            newport['name'] = name
-                        else:
-                            newport['name'] = collect['name'] + ("-%i" % c)
-                        # named ports can only be 15 chars :(
-                        if 'name' in newport and len(newport['name']) > 15:
-                            hashval = hashlib.sha1(newport['name'].encode()).hexdigest()
-                            newport['name'] = "port-" + hashval[0:7]
-                        newport['containerPort'] = addlport['containerPort']
-                        newport['protocol'] = "TCP"
-                        newports.append(newport)
-                    collect['additionalPorts'] = self.yaml.dump({ "additionalPorts": newports.copy() })
-            if 'volumeMounts' in container:
-                collect['volume-mounts'] = self.yaml.dump({ "volumeMounts": container['volumeMounts'] })
-            if 'env' in container:
-                collect['env'] = self.yaml.dump( container['env'] )
-            if 'resources' in container:
-                collect['resources'] = self.yaml.dump({ "resources": container['resources'] })
-            for probe in ('readinessProbe', 'livenessProbe'):
-                if probe in container:
-                    crp = container[probe]
-                    rp = {}
-                    for arg in ('initialDelaySeconds', 'periodSeconds', 'timeoutSeconds', 'successThreshold', 'failureThreshold'):
-                        if arg in crp:
-                            rp[arg] = crp[arg]
-                    if 'httpGet' in crp:
-                        rp['probeType'] = 'httpGet'
-                        rp['path'] = crp['httpGet']['path']
-                        rp['port'] = crp['httpGet']['port']
-                    elif 'tcpSocket' in crp:
-                        rp['probeType'] = 'tcpSocket'
-                        rp['port'] = crp['tcpSocket']['port']
-                    elif 'exec' in crp:
-                        rp['probeType'] = 'exec'
-                        rp['command'] = crp['exec']['command']
-                    collect[probe] = self.yaml.dump({ probe: rp })
-
-            self.deployments.append(collect)
+        volumes = None
+        if 'volumes' in podspec:
+            volumes = self.dump_fragment({ "volumes": podspec['volumes'] })
+        fields = self.container_fields
+        for listkey, infix in CONTAINER_LISTS:
+            for container in podspec.get(listkey) or ():
+                collect = {}
+                if volumes is not None:
+                    collect['volumes'] = volumes
+                # set first, other fields (like generated port names) use it
+                collect['name'] = container['name']
+                for key, value in container.items():
+                    extract = fields.get(key)
+                    if extract is not None:
+                        extract(self, value, collect)
+                self.extracted.append( (fileprefix + infix, collect) )
+
+    def load_ports(self, ports, collect):
+        if len(ports) < 1:
+            return
+        collect['port'] = ports[0]['containerPort']
+        if len(ports) > 1:
+            newports = []
+            for c, addlport in enumerate(ports[1:], 1):
+                newport = {}
+                if 'name' in addlport:
+                    newport['name'] = addlport['name']
+                else:
+                    newport['name'] = collect['name'] + ("-%i" % c)
+                # named ports can only be 15 chars :(
+                if len(newport['name']) > 15:
+                    hashval = hashlib.sha1(newport['name'].encode()).hexdigest()
+                    newport['name'] = "port-" + hashval[0:7]
+                newport['containerPort'] = addlport['containerPort']
+                newport['protocol'] = "TCP"
+                newports.append(newport)
+            collect['additionalPorts'] = self.dump_fragment({ "additionalPorts": newports })
+
+    def load_probe(self, crp):
+        rp = { arg: crp[arg] for arg in PROBE_ARGS if arg in crp }
+        if 'httpGet' in crp:
+            rp['probeType'] = 'httpGet'
+            rp['path'] = crp['httpGet']['path']
+            rp['port'] = crp['httpGet']['port']
+        elif 'tcpSocket' in crp:
+            rp['probeType'] = 'tcpSocket'
+            rp['port'] = crp['tcpSocket']['port']
+        elif 'exec' in crp:
+            rp['probeType'] = 'exec'
+            rp['command'] = crp['exec']['command']
+        return rp
 
     def load_secrets(self, doc):
-        print("load_secrets()")
+        if not self.quiet: print("load_secrets()")
         collect = {}
         if not 'metadata' in doc:
             raise Exception("'metadata' missing from secret")
@@ -142,28 +333,129 @@ class MakeHelmChartTemplate(object):
         if not 'data' in doc:
             raise Exception("'data' missing from secret")
         data = doc['data']
-        collect['secretData'] = self.yaml.dump( data )
+        collect['secretData'] = self.dump_fragment( data )
+
+        self.extracted.append( ("secret-", collect) )
 
-        self.secrets.append(collect)
 
+    def extract_docs(self, text):
+        """ Parse and extract every document in 'text' without keeping the results.
+            Returns a list of (fileprefix, data).
+        """
+        n = len(self.extracted)
+        try:
+            with self.phase("parse"):
+                for doc in self.yaml.load_all(text):
+                    if doc is not None:
+                        self.process_doc(doc)
+        except Exception:
+            del self.extracted[n:]
+            raise
+        extracted = self.extracted[n:]
+        del self.extracted[n:]
+        return extracted
 
     def cmd_dump_all(self):
-        self.dump_data(self.deployments, "deployment-container-")
-        self.dump_data(self.secrets, "secret-")
+        self.dump_data(self.extracted)
 
-    def dump_data(self, data, fileprefix):
-        for i in data:
-            fn = fileprefix + "%s" % i['name']
+    def cmd_watch(self, interval=0.5):
+        """ Poll the manifests every 'interval' seconds. When one changes, only
+            the documents whose text changed are parsed and extracted again, and
+            only the output files whose data changed are rewritten or removed.
+        """
+        self.yaml = MyYAML(typ='safe')
+        extracted = {}  # document text hash -> [(fileprefix, data)]
+        files = {}      # manifest -> (stat key, [document text hashes])
+        written = {}    # output file -> hash of the data written to it
+        while True:
+            start, changed = time.perf_counter(), False
+            for fn in self.k8s_manifest:
+                try:
+                    st = os.stat(fn)
+                    key = (st.st_mtime_ns, st.st_size)
+                except FileNotFoundError:
+                    key = None
+                if fn in files and files[fn][0] == key:
+                    continue
+                previous = files[fn][1] if fn in files else []
+                hashes = []
+                if key is not None:
+                    try:
+                        with self.phase("read", fn), open(fn, 'r') as f:
+                            text = f.read()
+                    except Exception as e:
+                        print("Error: failed to read '%s', keeping previous data: %s" % (fn, e))
+                        files[fn] = (key, previous)
+                        changed = True
+                        continue
+                    if self.profiler is not None:
+                        self.profiler.file = fn
+                    for n, chunk in enumerate(self.doc_start.split(text)):
+                        h = hashlib.sha1(chunk.encode()).hexdigest()
+                        if h not in extracted:
+                            try:
+                                extracted[h] = self.extract_docs(chunk)
+                            except Exception as e:
+                                # keep what this document produced before, if anything
+                                print("Error: failed to process document %i of '%s', keeping previous data: %s" % (n, fn, e))
+                                if n >= len(previous):
+                                    continue
+                                h = previous[n]
+                        hashes.append(h)
+                files[fn] = (key, hashes)
+                changed = True
+                if self.profiler is not None:
+                    self.profiler.file = None
+            if changed:
+                live = [ h for key, hashes in files.values() for h in hashes ]
+                extracted = { h: extracted[h] for h in live }
+                self.extracted = [ e for h in live for e in extracted[h] ]
+                n = self.sync_data(written)
+                print("updated %i file(s) in %.1fms" % (n, (time.perf_counter() - start) * 1000))
+            time.sleep(interval)
+
+    def sync_data(self, written):
+        """ Write the output files whose data differs from what 'written' says was
+            last written, and remove the ones that are no longer produced.
+            Returns the number of files written or removed.
+        """
+        current = { self.data_filename(i, fileprefix): i for fileprefix, i in self.extracted }
+        n = 0
+        for fn in [ fn for fn in written if fn not in current ]:
+            if not self.quiet: print("removing file '%s'" % fn)
+            if os.path.exists(fn):
+                os.remove(fn)
+            del written[fn]
+            n += 1
+        for fn, i in current.items():
+            h = hashlib.sha1(json.dumps(i, sort_keys=True).encode()).hexdigest()
+            if written.get(fn) != h:
+                self.dump_file(i, fn)
+                written[fn] = h
+                n += 1
+        return n
+
+    def data_filename(self, i, fileprefix):
+        fn = fileprefix + "%s" % i['name']
+        if self.dump_json == True:
+            fn = fn + ".json"
+        elif self.dump_yaml == True:
+            fn = fn + ".yaml"
+        return fn
+
+    def dump_file(self, i, fn):
+        with self.phase("write"), open(fn, "w") as f:
+            if not self.quiet: print("creating file '%s'" % fn)
             if self.dump_json == True:
-                fn = fn + ".json"
+                json.dump(i, f, sort_keys=True, indent=4)
             elif self.dump_yaml == True:
-                fn = fn + ".yaml"
-            with open(fn, "w") as f:
-                print("creating file '%s'" % fn)
-                if self.dump_json == True:
-                    json.dump(i, f, sort_keys=True, indent=4)
-                elif self.dump_yaml == True:
-                    self.yaml.dump(i, f)
+                self.yaml.dump(i, f)
+
+    def dump_data(self, data):
+        for fileprefix, i in data:
+            self.dump_file(i, self.data_filename(i, fileprefix))
+
+MakeHelmChartTemplate.compile_spec()
 
 def usage():
     usage = """Usage: %s [OPTIONS] COMMAND [ARGS ..]
@@ -172,32 +464,73 @@ Commands:
     dump-all MANIFEST[..]               Parses all Kubernetes manifests passed and
                                         dumps their data into new files in the format
                                         chosen
+    watch MANIFEST[..]                  Like dump-all, but keeps running and updates
+                                        only the changed files whenever a MANIFEST
+                                        changes. Stop with Ctrl-C
 
 Options:
     -j,--json                   Dump data in JSON format
     -y,--yaml                   Dump data in YAML format
+    -i,--interval=SECONDS       How often watch checks for changes (default 0.5)
+    -q,--quiet                  Don't print progress for each file and document
+    --profile=FILE              Write a JSON report of the time used per phase
+                                (read, parse, extract:KIND, dump, write), in
+                                total and per input file, to FILE
+    --profile-memory            With --profile, also record memory allocated per
+                                phase using tracemalloc. Times in the report are
+                                then measured under tracing and run slower
+    --cprofile=FILE             Write a cProfile dump of the command to FILE
 """ % sys.argv[0]
     print(usage)
     exit(1)
 
 def main(argv):
     o = MakeHelmChartTemplate()
-    opts, args = getopt.getopt(argv, "jy", ["--json","--yaml"])
+    interval, profile, profile_memory, cprofile = 0.5, None, False, None
+    opts, args = getopt.getopt(argv, "jyi:q", ["json","yaml","interval=","quiet","profile=","profile-memory","cprofile="])
     for opt, arg in opts:
         if opt in ("-j","--json"):
             o.dump_json = True
         elif opt in ("-y","--yaml"):
             o.dump_yaml = True
+        elif opt in ("-i","--interval"):
+            interval = float(arg)
+        elif opt in ("-q","--quiet"):
+            o.quiet = True
+        elif opt == "--profile":
+            profile = arg
+        elif opt == "--profile-memory":
+            profile_memory = True
+        elif opt == "--cprofile":
+            cprofile = arg
     if len(args) < 1:
         usage()
-    if args[0] == "dump-all":
-        if len(args) < 2:
-            raise Exception("please pass one or more MANIFEST files")
-        [o.k8s_manifest.append(x) for x in args[1:]]
-        o.process_manifests()
-        o.cmd_dump_all()
-    else:
+    if args[0] not in ("dump-all", "watch"):
         usage()
+    if len(args) < 2:
+        raise Exception("please pass one or more MANIFEST files")
+    [o.k8s_manifest.append(x) for x in args[1:]]
+
+    if profile is not None:
+        o.enable_profiling(memory=profile_memory)
+    if cprofile is not None:
+        pr = cProfile.Profile()
+        pr.enable()
+    try:
+        if args[0] == "dump-all":
+            o.process_manifests()
+            o.cmd_dump_all()
+        elif args[0] == "watch":
+            try:
+                o.cmd_watch(interval)
+            except KeyboardInterrupt:
+                pass
+    finally:
+        if cprofile is not None:
+            pr.disable()
+            pr.dump_stats(cprofile)
+        if profile is not None:
+            o.profiler.write(profile)
 
 if __name__ == "__main__":
     main(sys.argv[1:])